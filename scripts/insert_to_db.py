@@ -38,61 +38,182 @@ import argparse
 from dotenv import load_dotenv, find_dotenv
 import os
 import psycopg2
+from psycopg2 import sql
 
+import contextlib
 import gzip
-import datetime
-import tempfile
+import io
+import shutil
+import socket
+import struct
+import subprocess
+
+# binary COPY framing, see "Binary Format" in https://www.postgresql.org/docs/current/sql-copy.html
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+PGCOPY_TRAILER = struct.pack("!h", -1)
+# inet family codes used by postgres' inet_send (PGSQL_AF_INET / PGSQL_AF_INET6)
+PGSQL_AF_INET = 2
+PGSQL_AF_INET6 = 3
+# bytes of decompressed input split into lines at a time
+READ_CHUNK_SIZE = 16 << 20
+# bytes handed to the server per read of the COPY stream (psycopg2 defaults to 8 KiB)
+COPY_BUFFER_SIZE = 1 << 20
+
+
+def encode_inet(ip):
+    """
+    Encode an ip address as a length-prefixed inet field of a binary COPY row.
+
+    :param ip: ip address as ascii bytes, IPv4 or IPv6
+    :return: bytes of the field, as expected by postgres' inet_recv
+    """
+    if b":" in ip:
+        inet = struct.pack("!BBBB", PGSQL_AF_INET6, 128, 0, 16) + socket.inet_pton(socket.AF_INET6, ip.decode())
+    else:
+        inet = struct.pack("!BBBB", PGSQL_AF_INET, 32, 0, 4) + socket.inet_pton(socket.AF_INET, ip.decode())
+    return struct.pack("!i", len(inet)) + inet
+
+
+@contextlib.contextmanager
+def open_gzip(file_name):
+    """
+    Open a gz file for binary reading. Decompression is delegated to pigz when available, so it runs in a separate
+    process alongside the parsing loop; otherwise fall back to the gzip module.
+    """
+    pigz = shutil.which("pigz")
+    if pigz is None:
+        with gzip.open(file_name) as in_file:
+            yield in_file
+        return
+
+    proc = subprocess.Popen([pigz, "-dc", file_name], stdout=subprocess.PIPE)
+    try:
+        yield proc.stdout
+    except BaseException:
+        # pigz's exit status here is a consequence of the error (e.g. it got the same SIGINT), don't mask it
+        proc.stdout.close()
+        proc.wait()
+        raise
+    proc.stdout.close()
+    if proc.wait() not in (0, -13):
+        # -13 (SIGPIPE) only means we stopped reading early
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+class MappingStream(io.RawIOBase):
+    """
+    Read-only file-like wrapper around an iterator of byte lines, so rows can be fed to ``copy_expert`` without
+    materializing them on disk first.
+    """
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buffer = b""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        if size < 0 or length < size:
+            for line in self.lines:
+                chunks.append(line)
+                length += len(line)
+                if 0 <= size <= length:
+                    break
+        data = b"".join(chunks)
+        if size < 0:
+            self.buffer = b""
+            return data
+        self.buffer = data[size:]
+        return data[:size]
 
 
 class MappingCommitter:
+    __slots__ = ("table_name", "input_file", "conn")
 
     def __init__(self, table_name, input_file):
-        self.table_name = table_name
+        # fold case like an unquoted identifier would, so quoting keeps resolving to the same table as before
+        self.table_name = table_name.lower()
         self.input_file = input_file
-        self.temp_file = None
         self.conn = None
 
+    @property
+    def table(self):
+        """
+        table name quoted as an SQL identifier, for composing statements with psycopg2.sql. A schema-qualified name
+        like myschema.mapping is quoted part by part, so it still resolves to the table in that schema.
+        """
+        return sql.Identifier(*self.table_name.split("."))
+
+    @property
+    def relation_name(self):
+        """table name without its schema, used to derive names of the table's constraint and staging table"""
+        return self.table_name.split(".")[-1]
+
     def extract_unique_domain_ip_mapping(self):
         """
-        Given a csv gz file, extract unique domain to ip pairs (use the most recent mapping), write to a temporary csv file
-        and return the file name.
+        Given a csv gz file, extract unique domain to ip pairs (use the most recent mapping).
 
-        :param csv_gz_file: the input compressed csv file
-        :return: name of the uncompressed csv file containing unique domain-ip mapping
+        :return: dict of domain to (date, encoded inet field), ready to be passed to iter_mapping_rows
         """
         domain_ip_map = {}
+        # far fewer distinct ips and dates than domains, share one object per value instead of one per row. ips are
+        # pooled already encoded, so each one is parsed once and compared by identity afterwards.
+        date_pool = {}
+        inet_pool = {}
+        # bind lookups locally, this loop runs once per input row
+        get_mapping = domain_ip_map.get
+        intern_date = date_pool.setdefault
+        get_inet = inet_pool.get
 
-        with gzip.open(self.input_file) as in_file:
-            for line in in_file:
-                domain, date, ip = line.decode().strip().split(",")
-                if domain not in domain_ip_map:
-                    domain_ip_map[domain] = (date, ip)
-                else:
-                    old_date, old_ip = domain_ip_map[domain]
-                    if ip == old_ip:
+        with open_gzip(self.input_file) as in_file:
+            # split large blocks into lines in one C call rather than reading the file line by line
+            remainder = b""
+            while True:
+                chunk = in_file.read(READ_CHUNK_SIZE)
+                lines = (remainder + chunk).split(b"\n")
+                remainder = lines.pop() if chunk else b""
+                for line in lines:
+                    if not line:
                         continue
-                    date_obj = datetime.datetime.strptime(date, '%Y-%m-%d')
-                    old_date_obj = datetime.datetime.strptime(old_date, '%Y-%m-%d')
-                    if date_obj > old_date_obj:
-                        domain_ip_map[domain] = (date, ip)
+                    # stay in bytes: decoding and re-splitting every row as str is the bulk of the loop cost
+                    domain, date, ip = line.rstrip(b"\r").split(b",", 2)
+                    inet = get_inet(ip)
+                    if inet is None:
+                        inet = inet_pool[ip] = encode_inet(ip)
+                    old = get_mapping(domain)
+                    # dates are fixed-width YYYY-MM-DD, so byte-wise comparison is chronological
+                    if old is None or (inet is not old[1] and date > old[0]):
+                        domain_ip_map[domain] = (intern_date(date, date), inet)
+                if not chunk:
+                    break
+
+        return domain_ip_map
 
-        fh = tempfile.NamedTemporaryFile(delete=False, mode="w")
-        for domain, (_, ip) in domain_ip_map.items():
-            fh.write(f"{domain},{ip}\n")
-        fh.flush()
-        self.temp_file = fh.name
+    @staticmethod
+    def iter_mapping_rows(domain_ip_map):
+        """
+        Yield the unique mapping encoded as a binary COPY stream, so the server does not have to parse text rows or
+        inet strings.
+        """
+        yield PGCOPY_HEADER
+        for domain, (_, inet) in domain_ip_map.items():
+            yield struct.pack("!hi", 2, len(domain)) + domain + inet
+        yield PGCOPY_TRAILER
 
     def create_table(self):
         try:
             cur = self.conn.cursor()
-            cur.execute(f"""
-            CREATE TABLE {self.table_name}
+            # the mapping is fully recomputed from the input file on every upload, so skip WAL for it
+            cur.execute(sql.SQL("""
+            CREATE UNLOGGED TABLE {}
         (
             domain character varying NOT NULL,
-            ip inet NOT NULL,
-            PRIMARY KEY (domain)
+            ip inet NOT NULL
         )
-            """)
+            """).format(self.table))
         except psycopg2.errors.DuplicateTable as e:
             # table already exist, it's fine
             return
@@ -111,19 +232,81 @@ class MappingCommitter:
 
         self.conn = psycopg2.connect(**cred)
 
-    def upload_mapping(self, delete=False):
+    @contextlib.contextmanager
+    def bulk_load(self):
+        """
+        Run a full reload of the table in one transaction, yielding the cursor to load rows with.
+
+        The primary key is dropped for the load and rebuilt afterwards, so the index is built with one sort instead of
+        being maintained for every copied row.
+        """
         cur = self.conn.cursor()
+        try:
+            cur.execute("SET LOCAL synchronous_commit = off")
+            cur.execute("SET LOCAL maintenance_work_mem = '2GB'")
+            # look the key up rather than guessing its name, older runs let postgres generate it
+            cur.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'",
+                        (self.table.as_string(cur),))
+            for conname, in cur.fetchall():
+                cur.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(self.table, sql.Identifier(conname)))
+            cur.execute(sql.SQL("TRUNCATE TABLE {}").format(self.table))
 
-        cur.execute(f"delete from {self.table_name}")
-        self.conn.commit()
+            yield cur
 
-        f = open(self.temp_file)
-        cur.copy_from(f, self.table_name, sep=",")
+            cur.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} PRIMARY KEY (domain)").format(
+                self.table, sql.Identifier(f"{self.relation_name}_pkey")))
+        except Exception:
+            self.conn.rollback()
+            raise
         self.conn.commit()
-        f.close()
 
-        if delete:
-            os.remove(self.temp_file)
+    def upload_mapping(self, rows):
+        """
+        Replace the table content with the given binary COPY stream chunks, read straight from the iterator.
+        """
+        with self.bulk_load() as cur:
+            cur.copy_expert(sql.SQL("COPY {} FROM STDIN WITH (FORMAT BINARY)").format(self.table), MappingStream(rows),
+                            size=COPY_BUFFER_SIZE)
+
+    def upload_raw_mapping(self):
+        """
+        Replace the table content by copying the raw input file into a staging table and letting the database pick
+        the most recent mapping per domain, instead of deduplicating in Python.
+
+        Among rows with the same latest date, the first one in the input file wins, as in
+        extract_unique_domain_ip_mapping. Unlike there, this always keeps the ip of the latest date, even if the same
+        ip was also seen earlier.
+        """
+        stage = sql.Identifier(f"{self.relation_name}_stage")
+        cur = self.conn.cursor()
+        try:
+            # session-local and dropped at commit, so it cannot clash with a real table of the same name
+            cur.execute(sql.SQL("""
+            CREATE TEMPORARY TABLE {}
+        (
+            seq bigint GENERATED ALWAYS AS IDENTITY,
+            domain character varying NOT NULL,
+            date date NOT NULL,
+            ip inet NOT NULL
+        ) ON COMMIT DROP
+            """).format(stage))
+
+            with open_gzip(self.input_file) as in_file:
+                cur.copy_expert(sql.SQL("COPY {} (domain, date, ip) FROM STDIN WITH (FORMAT CSV)").format(stage), in_file,
+                                size=COPY_BUFFER_SIZE)
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        # the staging table is filled before bulk_load locks the live table, so the lock only covers the insert and
+        # the index build; both run in the same transaction as the copy above
+        with self.bulk_load() as cur:
+            # the DISTINCT ON sort is bounded by work_mem, not the maintenance_work_mem raised for the index build
+            cur.execute("SET LOCAL work_mem = '2GB'")
+            cur.execute(sql.SQL("""
+            INSERT INTO {} (domain, ip)
+            SELECT DISTINCT ON (domain) domain, ip FROM {} ORDER BY domain, date DESC, seq
+            """).format(self.table, stage))
 
 
 if __name__ == "__main__":
@@ -139,6 +322,10 @@ if __name__ == "__main__":
                         nargs='?', required=True,
                         help='Input file name')
 
+    parser.add_argument('--dedup-in-db',
+                        action='store_true', required=False,
+                        help='copy the raw input to a staging table and deduplicate in the database')
+
     opts = vars(parser.parse_args())
 
     print(opts)
@@ -157,5 +344,8 @@ if __name__ == "__main__":
 
     committer.create_conn()
     committer.create_table()
-    committer.extract_unique_domain_ip_mapping()
-    committer.upload_mapping(delete=True)
+    if opts["dedup_in_db"]:
+        committer.upload_raw_mapping()
+    else:
+        domain_ip_map = committer.extract_unique_domain_ip_mapping()
+        committer.upload_mapping(committer.iter_mapping_rows(domain_ip_map))